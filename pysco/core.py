@@ -1,21 +1,58 @@
 import numpy as np
-import matplotlib.pyplot as plt
 # import pdb
 from scipy.signal import medfilt2d as medfilt
-from scipy.io.idl import readsav
-import pyfits as pf
 import sys
+import math
 import multiprocessing
-from scipy.interpolate import griddata
 from scipy.ndimage import gaussian_filter
+from scipy.special import j1
+
+# matplotlib, the fits readers and readsav are only imported by the few
+# functions that need them: this keeps "import core" light for batch
+# processing and for multiprocessing workers.
+
+# numba is optional: the compiled kernels below are only used if available
+try:
+    from numba import njit, prange
+    has_numba = True
+except ImportError:
+    has_numba = False
 
 ''' ================================================================
     Tools and functions useful for manipulating kernel phase data.
     ================================================================ '''
 
 shift = np.fft.fftshift
-fft   = np.fft.fft2
-ifft  = np.fft.ifft2
+
+# FFT backend, in order of preference:
+# - pyfftw, if available: FFTW plans are cached and reused between calls
+#   (frame sizes do not change within a datacube)
+# - scipy.fft (pocketfft, scipy >= 1.4), multi-threaded
+# - numpy.fft
+# The first two keep single precision inputs in single precision.
+_fft_threads = multiprocessing.cpu_count() # set to 1 in worker processes
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft as _fftw
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+    def fft(a):
+        return _fftw.fft2(a, threads=_fft_threads, planner_effort='FFTW_MEASURE')
+    def ifft(a):
+        return _fftw.ifft2(a, threads=_fft_threads, planner_effort='FFTW_MEASURE')
+except ImportError:
+    try:
+        import scipy.fft as sfft
+        def fft(a):  return sfft.fft2(a, workers=_fft_threads)
+        def ifft(a): return sfft.ifft2(a, workers=_fft_threads)
+    except ImportError:
+        fft   = np.fft.fft2
+        ifft  = np.fft.ifft2
+
+try:
+    from scipy.fft import next_fast_len
+except ImportError:
+    from scipy.fftpack import next_fast_len
 
 dtor = np.pi/180.0
 m_zero=1e-10 # machine zero
@@ -23,6 +60,25 @@ m_zero=1e-10 # machine zero
 # =========================================================================
 # =========================================================================
 
+def _fits():
+    ''' The fits I/O module: astropy.io.fits, or the older pyfits '''
+    try:
+        from astropy.io import fits
+    except ImportError:
+        import pyfits as fits
+    return fits
+
+def _cupy():
+    ''' The CuPy module if it is available (for GPU transforms), else None '''
+    try:
+        import cupy
+    except ImportError:
+        return None
+    return cupy
+
+# =========================================================================
+# =========================================================================
+
 def mas2rad(x):
     ''' Convenient little function to convert milliarcsec to radians '''
     return x*np.pi/(180*3600*1000)
@@ -37,12 +93,110 @@ def rad2mas(x):
 # =========================================================================
 # =========================================================================
 
+def _fft_size(n):
+    ''' Smallest even size >= n that the FFT handles efficiently.
+
+    Even sizes keep the image centre at sz/2, as expected by fftshift. '''
+    sz = next_fast_len(int(n))
+    while sz % 2:
+        sz = next_fast_len(sz+1)
+    return sz
+
+# =========================================================================
+# =========================================================================
+
+def _cache_put(cache, key, value):
+    ''' cache[key] = value, for the bounded (dict) caches of this module:
+    the cache is emptied first if it already holds 8 entries '''
+    if len(cache) >= 8: cache.clear()
+    cache[key] = value
+
+# (-1)**(i+j) checkerboards used by _centered_fft(), one per frame size,
+# and their device copies for _centered_fft_gpu()
+_checkerboards = {}
+_gpu_checkerboards = {}
+
+def _checkerboard(sz):
+    ''' Read-only (sz x sz) int8 (-1)**(i+j) checkerboard '''
+    if sz not in _checkerboards:
+        ij = np.arange(sz)
+        chk = (1 - 2*(np.add.outer(ij, ij) & 1)).astype(np.int8)
+        chk.setflags(write=False)
+        _cache_put(_checkerboards, sz, chk)
+    return _checkerboards[sz]
+
+def _centered_fft(im):
+    ''' Same as shift(fft(shift(im))), without the two fftshift copies.
+
+    The transform applies to the last two axes, so that a datacube is
+    transformed frame by frame.
+
+    For square frames of even size, shifting both the input and the
+    output by half the frame size amounts to multiplying them by the
+    (-1)**(i+j) checkerboard. Other frames use the fftshift version. '''
+    sz = im.shape[-1]
+    if im.shape[-2] != sz or sz % 2:
+        return shift(fft(shift(im, axes=(-2,-1))), axes=(-2,-1))
+    chk = _checkerboard(sz)
+    ac = fft(im * chk)
+    ac *= chk
+    return ac
+
+def _centered_fft_gpu(cp, im):
+    ''' _centered_fft() computed on the GPU: returns a CuPy array '''
+    im = cp.asarray(im)
+    sz = im.shape[-1]
+    if im.shape[-2] != sz or sz % 2:
+        return cp.fft.fftshift(cp.fft.fft2(cp.fft.fftshift(im, axes=(-2,-1))),
+                               axes=(-2,-1))
+    if sz not in _gpu_checkerboards: # upload the mask once per size
+        _cache_put(_gpu_checkerboards, sz, cp.asarray(_checkerboard(sz)))
+    chk = _gpu_checkerboards[sz]
+    ac = cp.fft.fft2(im * chk)
+    ac *= chk
+    return ac
+
+# =========================================================================
+# =========================================================================
+
 def rebin(a, shape):
     sh = shape[0],a.shape[0]//shape[0],shape[1],a.shape[1]//shape[1]
-    return a.reshape(sh).mean(-1).mean(1)
+    return a.reshape(sh).sum(axis=(1,3)) * (1.0/(sh[1]*sh[3]))
 
 # =========================================================================
 # =========================================================================
+if has_numba:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _cvis_binary_kernel(u, v, kx, ky, l1, l2, out):
+        ''' Complex visibility of two point sources of luminosities l1
+        and l2, with phase (kx*u + ky*v), written into out. '''
+        for k in prange(u.size):
+            arg = kx*u[k] + ky*v[k]
+            out[k] = complex(l1 + l2*math.cos(arg), l2*math.sin(arg))
+
+    @njit(fastmath=True, cache=True)
+    def _phase_binary_kernel(u, v, kx, ky, l1, l2, out):
+        ''' Phase (deg) of the two point sources visibility, written
+        into out. Serial: the fitters call it on a few baselines. '''
+        for k in range(u.size):
+            arg = kx*u[k] + ky*v[k]
+            out[k] = math.atan2(l2*math.sin(arg),
+                                l1 + l2*math.cos(arg)) * (180.0/math.pi)
+
+def _binary_coeffs(p, wavel):
+    ''' Binary parameters p -> (kx, ky, l1, l2): the visibility phase is
+    kx*u + ky*v (scalars, unless wavel is an array) and l1, l2 are the
+    "luminosities" of the primary and the secondary. '''
+    # relative locations
+    th = (p[1] + 90.0) * np.pi / 180.0
+    ddec =  mas2rad(p[0] * np.sin(th))
+    dra  = -mas2rad(p[0] * np.cos(th))
+
+    # decompose into two "luminosity"
+    l2 = 1. / (p[2] + 1)
+    l1 = 1 - l2
+    return -2*np.pi*dra/wavel, -2*np.pi*ddec/wavel, l1, l2
+
 #[AL: 2014.05.15] Normalization was fixed
 def cvis_binary(u, v, wavel, p, norm=False):
     ''' Calc. complex vis measured by an array for a binary star
@@ -63,22 +217,25 @@ def cvis_binary(u, v, wavel, p, norm=False):
     ---------------------------------------------------------------- '''
 
     p = np.array(p)
-    # relative locations
-    th = (p[1] + 90.0) * np.pi / 180.0
-    ddec =  mas2rad(p[0] * np.sin(th))
-    dra  = -mas2rad(p[0] * np.cos(th))
+    kx, ky, l1, l2 = _binary_coeffs(p, wavel)
+
+    # two point sources, single wavelength, 1D baselines: compiled,
+    # allocation-free loop over baselines
+    if (has_numba and p.size != 5 and np.ndim(wavel) == 0 and
+        np.ndim(u) == 1 and np.shape(v) == np.shape(u)):
+        cvis = np.empty(u.size, dtype=complex)
+        _cvis_binary_kernel(u, v, float(kx), float(ky), l1, l2, cvis)
+        if norm :
+            cvis/=(l1+l2)
+        return cvis
 
     # baselines into number of wavelength
     x = np.sqrt(u*u+v*v)/wavel
 
-    # decompose into two "luminosity"
-    l2 = 1. / (p[2] + 1)
-    l1 = 1 - l2
-    
-    # phase-factor
-    phi = np.zeros(u.size, dtype=complex)
-    phi.real = np.cos(-2*np.pi*(u*dra + v*ddec)/wavel)
-    phi.imag = np.sin(-2*np.pi*(u*dra + v*ddec)/wavel)
+    # phase-factor, built in a single reused buffer
+    tmp = u*kx
+    tmp += v*ky
+    phi = np.exp(1j*tmp)
 
     # optional effect of resolved individual sources
     if p.size == 5:
@@ -114,8 +271,18 @@ def phase_binary(u, v, wavel, p):
     ---------------------------------------------------------------- '''
                 
     #[AL: 2014.05.15] Duplicated code was cleaned           
-    phase = np.angle(cvis_binary(u, v, wavel, p), deg=True)
-    return np.mod(phase + 10980., 360.) - 180.0
+    # two point sources, single wavelength, 1D baselines: straight to the
+    # phase, no complex temporary
+    if (has_numba and np.size(p) != 5 and np.ndim(wavel) == 0 and
+        np.ndim(u) == 1 and np.shape(v) == np.shape(u)):
+        kx, ky, l1, l2 = _binary_coeffs(np.array(p), wavel)
+        phase = np.empty(u.size)
+        _phase_binary_kernel(u, v, float(kx), float(ky), l1, l2, phase)
+        return phase
+
+    # arctan2 is already within [-180, 180] deg: no need to re-wrap it
+    cvis = cvis_binary(u, v, wavel, p)
+    return np.arctan2(cvis.imag, cvis.real) * (180.0/np.pi)
 
 # =========================================================================
 # =========================================================================
@@ -137,7 +304,7 @@ def vis2_binary(u, v, wavel, p):
     ---------------------------------------------------------------- '''
     #[AL: 2014.05.15] Duplicated code was cleaned   
     cvis=cvis_binary(u, v, wavel, p, norm=True)             
-    vis2 = np.real(cvis*cvis.conjugate())
+    vis2 = cvis.real*cvis.real + cvis.imag*cvis.imag # |cvis|^2
     
     return vis2
 
@@ -153,11 +320,11 @@ def super_gauss(xs, ys, x0, y0, w):
     - w        : width of the Super-Gaussian 
     ------------------------------------------ '''
 
-    x = np.outer(np.arange(xs), np.ones(ys))-x0
-    y = np.outer(np.ones(xs), np.arange(ys))-y0
-    dist = np.sqrt(x**2 + y**2)
+    x = (np.arange(xs)-x0)[:,None]  # broadcasts against y: no full-size
+    y = (np.arange(ys)-y0)[None,:]  # coordinate arrays are needed
+    r2 = (x*x + y*y) * (1.0/(w*w))  # (dist/w)**2, without the sqrt
 
-    gg = np.exp(-(dist/w)**4)
+    gg = np.exp(-(r2*r2))
     return gg
 
 # =========================================================================
@@ -168,27 +335,74 @@ def centroid(image, threshold=0, binarize=0):
         simple determination of the centroid of a 2D array
     ------------------------------------------------------ '''
 
-    signal = np.where(image > threshold)
+    signal = image > threshold
     sy, sx = image.shape[0], image.shape[1] # size of "image"
-    bkg_cnt = np.median(image)                                       
 
-    temp = np.zeros((sy, sx))
-    if (binarize == 1): temp[signal] = 1.0
-    else:               temp[signal] = image[signal]
-
-    profx = 1.0 * temp.sum(axis=0)
-    profy = 1.0 * temp.sum(axis=1)
-    profx -= np.min(profx)                                           
+    if (binarize == 1):
+        profx = signal.sum(axis=0).astype(float)
+        profy = signal.sum(axis=1).astype(float)
+    else:
+        temp  = np.where(signal, image, 0.0)
+        profx = temp.sum(axis=0)
+        profy = temp.sum(axis=1)
+    profx -= np.min(profx)
     profy -= np.min(profy)
 
-    x0 = (profx*np.arange(sx)).sum() / profx.sum()
-    y0 = (profy*np.arange(sy)).sum() / profy.sum()
+    x0 = np.dot(np.arange(sx), profx) / profx.sum()
+    y0 = np.dot(np.arange(sy), profy) / profy.sum()
 
     return (x0, y0)
 
 # =========================================================================
 # =========================================================================
 
+if has_numba:
+    @njit(cache=True, fastmath=True, error_model='numpy')
+    def _psf_iter(mfilt, signal, x0, y0, x1, y1):
+        ''' One find_psf_center() iteration: photo-center of mfilt*signal
+        within the [y0:y1, x0:x1] window, in a single pass. '''
+        tot, xtot, ytot = 0.0, 0.0, 0.0
+        for j in range(y0, y1):
+            for i in range(x0, x1):
+                w = mfilt[j, i] * signal[j, i]
+                tot  += w
+                xtot += w * i
+                ytot += w * j
+        return xtot / tot, ytot / tot
+
+if has_numba:
+    @njit(cache=True)
+    def _cswap(w, a, b):
+        if w[a] > w[b]:
+            w[a], w[b] = w[b], w[a]
+
+    @njit(parallel=True, cache=True)
+    def _median3x3(a, out):
+        ''' 3x3 median filter of a into out, zero-padded like medfilt2d.
+
+        The median of the 9 neighbours is selected with a 19 compare-swap
+        sorting network instead of a generic sort. '''
+        sy, sx = a.shape
+        for j in prange(sy):
+            w = np.empty(9)
+            for i in range(sx):
+                n = 0
+                for jj in range(j-1, j+2):
+                    for ii in range(i-1, i+2):
+                        if 0 <= jj < sy and 0 <= ii < sx:
+                            w[n] = a[jj, ii]
+                        else:
+                            w[n] = 0.0
+                        n += 1
+                _cswap(w, 1, 2); _cswap(w, 4, 5); _cswap(w, 7, 8)
+                _cswap(w, 0, 1); _cswap(w, 3, 4); _cswap(w, 6, 7)
+                _cswap(w, 1, 2); _cswap(w, 4, 5); _cswap(w, 7, 8)
+                _cswap(w, 0, 3); _cswap(w, 5, 8); _cswap(w, 4, 7)
+                _cswap(w, 3, 6); _cswap(w, 1, 4); _cswap(w, 2, 5)
+                _cswap(w, 4, 7); _cswap(w, 4, 2); _cswap(w, 6, 4)
+                _cswap(w, 4, 2)
+                out[j, i] = w[4]
+
 def find_psf_center(img, verbose=True, nbit=10):                     
     ''' Name of function self explanatory: locate the center of a PSF.
 
@@ -203,7 +417,11 @@ def find_psf_center(img, verbose=True, nbit=10):
     temp = img.copy()
     bckg = np.median(temp)   # background level
     temp -= bckg
-    mfilt = medfilt(temp, 3) # median filtered, kernel size = 3
+    if has_numba:            # median filtered, kernel size = 3
+        mfilt = np.empty(temp.shape)
+        _median3x3(temp, mfilt)
+    else:
+        mfilt = medfilt(temp, 3)
     (sy, sx) = mfilt.shape   # size of "image"
     xc, yc = sx/2, sy/2      # first estimate for psf center
 
@@ -216,24 +434,27 @@ def find_psf_center(img, verbose=True, nbit=10):
 
     for it in xrange(nbit):
         sz = sx/2/(1.0+(0.1*sx/2*it/(4*nbit)))
-        x0 = np.max([int(0.5 + xc - sz), 0])
-        y0 = np.max([int(0.5 + yc - sz), 0])
-        x1 = np.min([int(0.5 + xc + sz), sx])
-        y1 = np.min([int(0.5 + yc + sz), sy])
-                                                                     
-        mask = np.zeros_like(img)
-        mask[y0:y1, x0:x1] = 1.0
-        
-        #plt.clf()
-        #plt.imshow((mfilt**0.2) * mask)
-        #plt.draw()
+        x0 = max(int(0.5 + xc - sz), 0)
+        y0 = max(int(0.5 + yc - sz), 0)
+        x1 = min(int(0.5 + xc + sz), sx)
+        y1 = min(int(0.5 + yc + sz), sy)
+
+        if has_numba:
+            xc, yc = _psf_iter(mfilt, signal, x0, y0, x1, y1)
+        else:
+            # only the window contributes: no need for a full-size mask
+            sub = mfilt[y0:y1, x0:x1] * signal[y0:y1, x0:x1]
+
+            #plt.clf()
+            #plt.imshow(mfilt[y0:y1, x0:x1]**0.2)
+            #plt.draw()
+
+            profx = sub.sum(axis=0)
+            profy = sub.sum(axis=1)
+
+            xc = np.dot(profx, np.arange(x0, x1)) / profx.sum()
+            yc = np.dot(profy, np.arange(y0, y1)) / profy.sum()
 
-        profx = (mfilt*mask*signal).sum(axis=0)
-        profy = (mfilt*mask*signal).sum(axis=1)
-        
-        xc = (profx*np.arange(sx)).sum() / profx.sum()
-        yc = (profy*np.arange(sy)).sum() / profy.sum()
-                  
         #pdb.set_trace()
                                                    
         if verbose:
@@ -244,6 +465,82 @@ def find_psf_center(img, verbose=True, nbit=10):
 # =========================================================================
 # =========================================================================
 
+# window_image(), recenter() and recenter2() masks for a given
+# (sz, sg_rad): they are identical for all the frames of a datacube, so
+# there is no need to rebuild them every time
+_sgmask_cache = {}
+_recenter_cache = {}
+
+def _sgmask(sz, sg_rad):
+    ''' Read-only (sz x sz) float64 super-Gaussian window of radius sg_rad,
+    centered on the (sz/2, sz/2) pixel, used by recenter2() '''
+    key = (sz, float(sg_rad))
+    if key not in _sgmask_cache:
+        sgmask = super_gauss(sz, sz, sz/2., sz/2., sg_rad)
+        sgmask.setflags(write=False)
+        _cache_put(_sgmask_cache, key, sgmask)
+    return _sgmask_cache[key]
+
+def _recenter_masks(sz, sg_rad):
+    ''' Returns the (sgmask, wedge, offset) arrays used by recenter()
+    (window_image() only uses sgmask)
+
+    - sgmask: super-Gaussian window (float32, read-only)
+    - wedge:  fftshifted 1D phase slope. The Fourier-translation is
+              separable, so it is computed from wedge along each axis
+    - offset: complex64 buffer for the phase ramp, overwritten by
+              each call to recenter() '''
+    key = (sz, float(sg_rad))
+    if key not in _recenter_cache:
+        dz = sz/2.
+        sgmask = super_gauss(sz, sz, dz, dz, sg_rad).astype(np.float32)
+        sgmask.setflags(write=False)
+        wedge = shift(np.arange(sz)-dz) * np.pi/dz
+        offset = np.zeros((sz, sz), dtype=np.complex64)
+        _cache_put(_recenter_cache, key, (sgmask, wedge, offset))
+    return _recenter_cache[key]
+
+# =========================================================================
+# =========================================================================
+
+def _zero_pad(im0, sz, dtype=float):
+    ''' im0 inserted at the center of a zero-padded (sz x sz) array
+
+    Works on the last two axes (a datacube is padded frame by frame).
+    Only the border is zero-filled: the rest is overwritten by im0. '''
+    szv, szh = im0.shape[-2:]
+    oriv, orih = (sz-szv)//2, (sz-szh)//2
+    im = np.empty(im0.shape[:-2] + (sz, sz), dtype=dtype)
+    im[..., :oriv, :] = 0
+    im[..., oriv+szv:, :] = 0
+    im[..., oriv:oriv+szv, :orih] = 0
+    im[..., oriv:oriv+szv, orih+szh:] = 0
+    im[..., oriv:oriv+szv, orih:orih+szh] = im0
+    return im
+
+if has_numba:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _window_kernel(im, bckg, sgmask):
+        ''' im = (im - bckg) * sgmask, in place and in a single pass '''
+        sy, sx = im.shape
+        for j in prange(sy):
+            for i in range(sx):
+                im[j, i] = (im[j, i] - bckg) * sgmask[j, i]
+
+def _apply_window(im, sgmask):
+    ''' Subtract the median of im and apply the sgmask window, in place
+
+    For frames larger than 256 pixels, the median is estimated on a
+    regular sub-grid of (at most) 256x256 pixels: plenty for a
+    background level, at a fraction of the cost. '''
+    step = -(-max(im.shape)//256) # ceil: at most 256 samples per axis
+    bckg = np.median(im[::step, ::step])
+    if has_numba:
+        _window_kernel(im, bckg, sgmask)
+    else:
+        im -= bckg
+        im *= sgmask
+
 # window image im0 by applying sg_rad supergaussian
 def window_image(im0,sg_rad) :
     if len(im0.shape)==2 :  
@@ -252,23 +549,15 @@ def window_image(im0,sg_rad) :
     elif len(im0.shape)==3 :  
         szh = im0.shape[2] # horiz
         szv = im0.shape[1] # vertic     
-    temp = max(szh,szv) # max dimension of image            
-    for sz in [64, 128, 256, 512, 1024, 2048]:
-        if sz >= temp: break
-    dz = sz/2.           # image half-size
-    orih, oriv = (sz-szh)/2, (sz-szv)/2
-    sgmask = super_gauss(sz, sz, dz, dz, sg_rad)                
+    sz = _fft_size(max(szh,szv)) # FFT-friendly size of padded image
+    sgmask = _recenter_masks(sz, sg_rad)[0] # same (cached) window as recenter()
     if len(im0.shape)==2 :  
-        im = np.zeros((sz, sz))
-        im[oriv:oriv+szv,orih:orih+szh] = im0
-        im -= np.median(im)
-        im*=sgmask
+        im = _zero_pad(im0, sz)
+        _apply_window(im, sgmask)
     elif len(im0.shape)==3 :  
-        im = np.zeros((im0.shape[0],sz, sz))
-        im[:,oriv:oriv+szv,orih:orih+szh] = im0
+        im = _zero_pad(im0, sz)
         for i in range(im.shape[0]) : 
-            im[i] -= np.median(im[i])
-            im[i]*=sgmask  
+            _apply_window(im[i], sgmask)
     return im
     
 
@@ -294,6 +583,7 @@ def recenter(im0, sg_rad=25.0, verbose=True, nbit=10, manual = 0):
         ------------------------------------------------------------ '''
     dim=len(im0.shape)
     if manual != 0 and dim==2:
+        import matplotlib.pyplot as plt
         plt.imshow(im0)
         print 'Manually windowing'
         print 'Click on the pixel at the new window centre... '
@@ -309,21 +599,14 @@ def recenter(im0, sg_rad=25.0, verbose=True, nbit=10, manual = 0):
     elif len(im0.shape)==3 :  
         szh = im0.shape[2] # horiz
         szv = im0.shape[1] # vertic     
-    temp = max(szh,szv) # max dimension of image            
-    for sz in [64, 128, 256, 512, 1024, 2048]:
-        if sz >= temp: break
+    sz = _fft_size(max(szh,szv)) # FFT-friendly size of padded image
     dz = sz/2.           # image half-size
-    orih, oriv = (sz-szh)/2, (sz-szv)/2
-    sgmask = super_gauss(sz, sz, dz, dz, sg_rad)    
-    
-    x,y = np.meshgrid(np.arange(sz)-dz, np.arange(sz)-dz)
-    wedge_x, wedge_y = x*np.pi/dz, y*np.pi/dz
-    offset = np.zeros((sz, sz), dtype=complex) # to Fourier-center array
+    sgmask, wedge, offset = _recenter_masks(sz, sg_rad)
 
-    # insert image in zero-padded array (dim. power of two)
+    # insert image in zero-padded array (FFT-friendly dim.)
+    # single precision is plenty for sub-pixel centering, at half the cost
     if len(im0.shape)==2 :  
-        im = np.zeros((sz, sz))
-        im[oriv:oriv+szv,orih:orih+szh] = im0
+        im = _zero_pad(im0, sz, np.float32)
         (x0, y0) = find_psf_center(im, verbose, nbit)
         im -= np.median(im)
         mynorm = (im * sgmask).sum()
@@ -332,30 +615,28 @@ def recenter(im0, sg_rad=25.0, verbose=True, nbit=10, manual = 0):
         #dx=1.0
         #dy=1.0 
         #print(" Test only! dx=%f, dy=%f " % (dx,dy))                   
-        im = np.roll(np.roll(im, -int(dx), axis=1), -int(dy), axis=0)        
-        dx -= np.int(dx)
-        dy -= np.int(dy)                    
+        # integer part of the shift (single copy), the rest in Fourier space
+        im = np.roll(im, (-int(dy), -int(dx)), axis=(0, 1))
+        dx -= int(dx)
+        dy -= int(dy)
         # array for Fourier-translation
-        dummy = shift(-dx * wedge_x + dy * wedge_y)
-        offset.real, offset.imag = np.cos(dummy), np.sin(dummy)
-        im = np.abs(shift(ifft(offset * fft(shift(im*sgmask)))))*sgmask
+        np.multiply(np.exp(1j*dy*wedge)[:,None], np.exp(-1j*dx*wedge), out=offset)
+        im = np.abs(shift(ifft(offset * fft(shift(im*sgmask)).astype(np.complex64, copy=False))))*sgmask
         # image masking, and set integral to right value        
         im=im * mynorm / im.sum()
     elif len(im0.shape)==3 :  
-        im = np.zeros((im0.shape[0],sz, sz))
-        im[:,oriv:oriv+szv,orih:orih+szh] = im0
+        im = _zero_pad(im0, sz, np.float32)
         for i in range(im.shape[0]) : 
             (x0, y0) = find_psf_center(im[i], verbose, nbit) 
             im[i] -= np.median(im[i])
             mynorm = (im[i] * sgmask).sum()
             dx, dy = (x0-dz), (y0-dz)                   
-            im[i] = np.roll(np.roll(im[i], -int(dx), axis=1), -int(dy), axis=0)
-            dx -= np.int(dx)
-            dy -= np.int(dy)
+            im[i] = np.roll(im[i], (-int(dy), -int(dx)), axis=(0, 1))
+            dx -= int(dx)
+            dy -= int(dy)
             # array for Fourier-translation
-            dummy = shift(-dx * wedge_x + dy * wedge_y)
-            offset.real, offset.imag = np.cos(dummy), np.sin(dummy)
-            im[i] = np.abs(shift(ifft(offset * fft(shift(im[i]*sgmask)))))*sgmask
+            np.multiply(np.exp(1j*dy*wedge)[:,None], np.exp(-1j*dx*wedge), out=offset)
+            im[i] = np.abs(shift(ifft(offset * fft(shift(im[i]*sgmask)).astype(np.complex64, copy=False))))*sgmask
             # image masking, and set integral to right value
             im=im[i] * mynorm / im[i].sum()
 
@@ -417,6 +698,7 @@ def get_nicmos_keywords(hdr):
 def get_idl_keywords(filename):
     '''Extract the relevant keyword information from an idlvar file.
     '''
+    from scipy.io.idl import readsav
     data = readsav(filename)
     wavel,bwidth = data['filter']
     data['filter'] = wavel
@@ -471,63 +753,140 @@ def get_simu_keywords(hdr):
     This is a special version for simulated data. '''
         
     # [AL,21.02.2014] Header parser was modified to support wider range of simulations  
-    #BJSP 13/11/14 changed to try-except framework as old version of pyfits is deprecated
-
-    try:
-        pscale=hdr['PSCALE']
-    except:
-      pscale=11.5
-    try:
-        fname=hdr['FNAME']
-    except:
-      fname='simulation'
-    try:
-        odate=hdr['ODATE']
-    except:
-      odate='Jan 1, 2000'
-    try:
-        otime=hdr['OTIME']
-    except:
-      otime='0:00:00.00'    
-    try:
-        tint=hdr['TINT']
-    except:
-      tint=1.0      
-    try:
-        coadds=hdr['COADDS']
-    except:
-      coadds=1      
-    try:
-        RA=hdr['RA']
-    except:
-      RA=0.0
-    try:
-        DEC=hdr['DEC']
-    except:
-      DEC=0.0   
-    try:
-        filter=hdr['FILTER']
-    except:
-      filter=1.6* 1e-6
-    try:
-        orient=hdr['ORIENT']
-    except:
-      orient=0.0                
+    # keywords missing from the header fall back to a default value:
+    # header.get() does the lookup and the fallback in a single call
     data = {
-        'tel'    : hdr['TELESCOP'],        # telescope
-        'pscale' : pscale,                 # simulation plate scale (mas)
-        'fname'  : fname,                  # original file name
-        'odate'  : odate,              # UTC date of observation
-        'otime'  : otime,                  # UTC time of observation
-        'tint'   : tint,                   # integration time (sec)
-        'coadds' : coadds,                 # number of coadds
-        'RA'     : RA,                     # right ascension (deg)
-        'DEC'    : DEC,                    # declination (deg)
-        'filter' : filter,                 # central wavelength (meters)
-        'orient' : orient                  # P.A. of the frame (deg)
+        'tel'    : hdr['TELESCOP'],                 # telescope
+        'pscale' : hdr.get('PSCALE', 11.5),         # simulation plate scale (mas)
+        'fname'  : hdr.get('FNAME', 'simulation'),  # original file name
+        'odate'  : hdr.get('ODATE', 'Jan 1, 2000'), # UTC date of observation
+        'otime'  : hdr.get('OTIME', '0:00:00.00'),  # UTC time of observation
+        'tint'   : hdr.get('TINT', 1.0),            # integration time (sec)
+        'coadds' : hdr.get('COADDS', 1),            # number of coadds
+        'RA'     : hdr.get('RA', 0.0),              # right ascension (deg)
+        'DEC'    : hdr.get('DEC', 0.0),             # declination (deg)
+        'filter' : hdr.get('FILTER', 1.6* 1e-6),    # central wavelength (meters)
+        'orient' : hdr.get('ORIENT', 0.0)           # P.A. of the frame (deg)
         }
     return data
 
+# =========================================================================
+# =========================================================================
+# Building blocks shared by extract_from_array() and extract_from_array_batch()
+
+# header parser for each TELESCOP value (matched as a substring)
+_KW_HANDLERS = (('Keck II', get_keck_keywords),
+                ('HST',     get_nicmos_keywords),
+                ('simu',    get_simu_keywords),
+                ('Hale',    get_pharo_keywords))
+
+def _kpd_header(hdr, kpi, rev=-1.0, wrad=25.0, sg_ld=1.0, D=0.0):
+    ''' Header keywords, orientation flag and super-Gaussian radius.
+
+    Returns (kpd_info, rev, sg_rad) '''
+    tel = hdr['TELESCOP']
+    for key, get_keywords in _KW_HANDLERS:
+        if key in tel:
+            kpd_info = get_keywords(hdr)
+            break
+    else:
+        raise ValueError('Unsupported TELESCOP keyword: %s' % (tel,))
+                    
+    if ('Hale' in tel) or ('simu' in tel): # P3K PA are clockwise
+                                                                     # [AL, 04.07.2014] removed reverse from simulation     
+        rev = -1.0                               
+                                    
+    # [AL, 2014.04.16] Added calculation of super gaussian radius in sg_ld*lambda/D
+    sg_rad = 0
+    if sg_ld*D>0 :                          
+        bl = D
+        if D<=0 :
+            bl=np.hypot(kpi.uv[:,0],kpi.uv[:,1]).min()
+        wl=kpd_info['filter']
+        pscale=kpd_info['pscale']
+        # integer radius, rounded up to the next even number of pixels
+        sg_rad=int(math.ceil((int(rad2mas(wl/bl)/pscale)+1)*sg_ld))
+        sg_rad+=sg_rad&1
+    elif wrad>0 :
+        sg_rad=wrad
+    return kpd_info, rev, sg_rad
+
+def _uv_sampling(kpi, kpd_info, sz, rev=-1.0, adjust_sampling=True):
+    ''' uv sample coordinates in a (sz x sz) Fourier plane.
+
+    Returns (uv_samp, uv_samp_rev): the sample coordinates in pixels, and
+    the (rounded, orientation-corrected) indices used to read them. '''
+    dz = sz/2
+
+    # meter to pixel conversion factor
+    m2pix = mas2rad(kpd_info['pscale']) * sz / kpd_info['filter']
+
+    # rotation of samples according to header info
+    #th = 90.0 * np.pi/180.
+    #rmat = np.matrix([[np.cos(th), np.sin(th)], [np.sin(th), -np.cos(th)]])
+    #uv_rot = np.dot(rmat, kpi.uv.T).T
+
+    uv_samp = kpi.uv * m2pix + dz # uv sample coordinates in pixels
+    #uv_samp = uv_rot * m2pix + dz # uv sample coordinates in pixels
+                
+    if adjust_sampling: 
+        uv_samp=adjust_samp(uv_samp,kpi,m2pix,sz) # rounding if not integer                         
+
+    # [AL, 2014.06.20] visibilities extraction
+    uv_samp_rev=np.rint(uv_samp).astype(int)
+    uv_samp_rev[:,0]*=int(rev) # rev is +/-1: keep the indices integer
+    return uv_samp, uv_samp_rev
+
+def _kpd_observables(ac, kpi, uv_samp_rev, bsp=False, unwrap_kp=False):
+    ''' Observables sampled from a normalized, centered Fourier transform.
+
+    Returns (kpd_phase, kpd_signal, vis2, bsp_res), bsp_res being None
+    unless bsp is set. '''
+    data_cplx=ac[uv_samp_rev[:,1], uv_samp_rev[:,0]]                
+                
+    viscen = ac.shape[0]//2
+    c = ac[viscen,viscen] # only |ac|^2 at the origin is needed
+    vis2 = data_cplx.real*data_cplx.real + data_cplx.imag*data_cplx.imag # |data_cplx|^2
+    vis2 /= (c.real*c.real + c.imag*c.imag) #normalise to the origin
+
+    # ---------------------------
+    # calculate the Kernel-phases
+    # ---------------------------
+
+    #kpd_phase = kpi.RED * np.angle(data_cplx) # in radians for WFS # [Al, 2014.05.12] Replaced by Frantz's version
+    #kpd_signal = np.dot(kpi.KerPhi, kpd_phase) / dtor # [Al, 2014.05.12] Replaced by Frantz's version
+    #kpd_phase = np.angle(data_cplx) # uv-phase (in radians for WFS) #[Al, 2014.05.12] Frantz's version #[AL, 2014.07.30 Replaced]
+
+    if not unwrap_kp :
+        kpd_phase = np.angle(data_cplx) # uv-phase (in radians for WFS) #[Al, 2014.05.12] Frantz's version #[AL, 2014.07.30 Replaced]
+        #[!!!!!!!!!Noise!!!!!!!!]
+        #for i in range(kpd_phase.shape[0]) : kpd_phase[i] = np.random.random()*(np.pi*2)-np.pi                             
+    else :
+        kpd_phase=unwrap_uv_phases(ac,uv_samp_rev,maxVar=np.pi)             
+    
+    
+    kpd_signal = np.dot(kpi.KerPhi, kpd_phase) / dtor #[Al, 2014.05.12] Frantz's version
+                        
+    # [AL, 2014.05.06] Bispectrum (bsp)
+    bsp_res = None
+    if bsp :                    
+        bsp_res=extract_bsp(data_cplx,kpi.uvrel) # robust to phase wrapping     
+       # bsp_res=extract_bsp(kpd_phase,kpi.uvrel,rng=(0,50000)) # works if unwrapping algorithm is fine. Can be used to check it as it is a requirement for kpd extraction
+    return kpd_phase, kpd_signal, vis2, bsp_res
+
+def _kpd_results(kpd_info, kpd_phase, kpd_signal, vis2, im, ac, bsp_res,
+                 save_im=False, wfs=False, bsp=False):
+    ''' The tuple returned by extract_from_array() for these options '''
+    if bsp :   
+        if (save_im): res = (kpd_info, kpd_signal,vis2, im, ac, bsp_res)
+        else:         res = (kpd_info, kpd_signal,vis2, bsp_res)
+        if (wfs):     res = (kpd_info, kpd_phase, bsp_res)                  
+    else :
+        if (save_im): res = (kpd_info, kpd_signal,vis2, im, ac)
+        else:         res = (kpd_info, kpd_signal,vis2)
+        if (wfs):     res = (kpd_info, kpd_phase)
+    return res
+
 # =========================================================================
 # =========================================================================
 # [AL, 2014.04.16] Added sg_ld and D parameters - window size in lambda/D
@@ -581,29 +940,8 @@ def extract_from_array(array, hdr, kpi, save_im=False, wfs=False, plotim=False,
 
     ---------------------------------------------------------------- '''
 
-    if 'Keck II' in hdr['TELESCOP']: kpd_info = get_keck_keywords(hdr)
-    if 'HST'     in hdr['TELESCOP']: kpd_info = get_nicmos_keywords(hdr)
-    if 'simu'    in hdr['TELESCOP']: kpd_info = get_simu_keywords(hdr)
-    if 'Hale'    in hdr['TELESCOP']: kpd_info = get_pharo_keywords(hdr)
-                    
-    if ('Hale' in hdr['TELESCOP']) or ('simu' in hdr['TELESCOP']): # P3K PA are clockwise
-                                                                     # [AL, 04.07.2014] removed reverse from simulation     
-        rev = -1.0                               
-                                    
-    # [AL, 2014.04.16] Added calculation of super gaussian radius in sg_ld*lambda/D
-    if sg_ld*D>0 :                          
-        bl = D
-        if D<=0 :
-            bl=np.hypot(kpi.uv[:,0],kpi.uv[:,1]).min()
-        wl=kpd_info['filter']
-        pscale=kpd_info['pscale']
-        sg_rad=int(rad2mas(wl/bl)/pscale)+1   
-        sg_rad*=sg_ld   
-        sg_rad+=(sg_rad%2)  
-    elif wrad>0 :
-        sg_rad=wrad
-                    
-                
+    kpd_info, rev, sg_rad = _kpd_header(hdr, kpi, rev, wrad, sg_ld, D)
+
     # read and fine-center the frame
     # [AL, 2014.04.16] sg_rad=wrad changed
     if sg_rad<=0 : sg_rad=array.shape[1]
@@ -619,89 +957,161 @@ def extract_from_array(array, hdr, kpi, save_im=False, wfs=False, plotim=False,
         im = array.copy()
 
     sz, dz = im.shape[0], im.shape[0]/2  # image is now square
+    uv_samp, uv_samp_rev = _uv_sampling(kpi, kpd_info, sz, rev, adjust_sampling)
 
-    # meter to pixel conversion factor
-    m2pix = mas2rad(kpd_info['pscale']) * sz / kpd_info['filter']
+    # calculate and normalize Fourier Transform
+    # (single precision: ample for the phases of a detector image)
+    ac = _centered_fft(im.astype(np.float32, copy=False))
+    ac = ac.astype(np.complex64, copy=False)
+    ac /= np.sqrt((ac.real*ac.real + ac.imag*ac.imag).max()) / kpi.nbh
 
-    # rotation of samples according to header info
-    #th = 90.0 * np.pi/180.
-    #rmat = np.matrix([[np.cos(th), np.sin(th)], [np.sin(th), -np.cos(th)]])
-    #uv_rot = np.dot(rmat, kpi.uv.T).T
+    kpd_phase, kpd_signal, vis2, bsp_res = \
+        _kpd_observables(ac, kpi, uv_samp_rev, bsp=bsp, unwrap_kp=unwrap_kp)
 
-    uv_samp = kpi.uv * m2pix + dz # uv sample coordinates in pixels
-    #uv_samp = uv_rot * m2pix + dz # uv sample coordinates in pixels
-                
-    if adjust_sampling: 
-        uv_samp=adjust_samp(uv_samp,kpi,m2pix,sz) # rounding if not integer                         
-       
-    # calculate and normalize Fourier Transform
-    ac = shift(fft(shift(im)))
-    ac /= (np.abs(ac)).max() / kpi.nbh
+    res = _kpd_results(kpd_info, kpd_phase, kpd_signal, vis2, im, ac, bsp_res,
+                       save_im=save_im, wfs=wfs, bsp=bsp)
+    
+    if plotim:
+        _plot_extraction(im, ac, uv_samp, uv_samp_rev, dz)
 
-    # [AL, 2014.06.20] visibilities extraction
-    uv_samp_rev=np.cast['int'](np.round(uv_samp))
-    uv_samp_rev[:,0]*=rev
-    data_cplx=ac[uv_samp_rev[:,1], uv_samp_rev[:,0]]                
-                
-    vis = np.real(ac*ac.conjugate())
-    viscen = vis.shape[0]/2
-    vis2 = np.real(data_cplx*data_cplx.conjugate())
-    vis2 /= vis[viscen,viscen] #normalise to the origin
+    return res
 
-    # ---------------------------
-    # calculate the Kernel-phases
-    # ---------------------------
+# figure (and its artists) used by _plot_extraction(), kept between calls
+_plot_state = {}
 
-    #kpd_phase = kpi.RED * np.angle(data_cplx) # in radians for WFS # [Al, 2014.05.12] Replaced by Frantz's version
-    #kpd_signal = np.dot(kpi.KerPhi, kpd_phase) / dtor # [Al, 2014.05.12] Replaced by Frantz's version
-    #kpd_phase = np.angle(data_cplx) # uv-phase (in radians for WFS) #[Al, 2014.05.12] Frantz's version #[AL, 2014.07.30 Replaced]
+def _plot_extraction(im, ac, uv_samp, uv_samp_rev, dz):
+    ''' Plot of the image, the power spectrum and the Fourier phase, with
+    the uv samples overlaid (extract_from_array(..., plotim=True)).
 
-    if not unwrap_kp :
-        kpd_phase = np.angle(data_cplx) # uv-phase (in radians for WFS) #[Al, 2014.05.12] Frantz's version #[AL, 2014.07.30 Replaced]
-        #[!!!!!!!!!Noise!!!!!!!!]
-        #for i in range(kpd_phase.shape[0]) : kpd_phase[i] = np.random.random()*(np.pi*2)-np.pi                             
-    else :
-        kpd_phase=unwrap_uv_phases(ac,uv_samp_rev,maxVar=np.pi)             
-    
-    
-    kpd_signal = np.dot(kpi.KerPhi, kpd_phase) / dtor #[Al, 2014.05.12] Frantz's version
-                        
-    # [AL, 2014.05.06] Bispectrum (bsp)
-    if bsp :                    
-        bsp_res=extract_bsp(data_cplx,kpi.uvrel) # robust to phase wrapping     
-       # bsp_res=extract_bsp(kpd_phase,kpi.uvrel,rng=(0,50000)) # works if unwrapping algorithm is fine. Can be used to check it as it is a requirement for kpd extraction
-                                
-    if bsp :   
-        if (save_im): res = (kpd_info, kpd_signal,vis2, im, ac, bsp_res)
-        else:         res = (kpd_info, kpd_signal,vis2, bsp_res)
-        if (wfs):     res = (kpd_info, kpd_phase, bsp_res)                  
-    else :
-        if (save_im): res = (kpd_info, kpd_signal,vis2, im, ac)
-        else:         res = (kpd_info, kpd_signal,vis2)
-        if (wfs):     res = (kpd_info, kpd_phase)
+    The figure is only built on the first call (or if it was closed, or
+    the frame size changed): the following calls update its content. '''
+    import matplotlib.pyplot as plt
+    uvw = np.max(uv_samp)/2
 
-    
-    if plotim:
-        uvw = np.max(uv_samp)/2
-        plt.clf()
-        plt.figure(1, (15,5))
-        f0 = plt.subplot(131)
-        f0.imshow(im**0.5)
-                
+    fig = _plot_state.get('fig')
+    rebuild = (fig is None or not plt.fignum_exists(fig.number) or
+               _plot_state['shape'] != im.shape)
+    if rebuild:
+        _plot_state['disp'] = np.empty(im.shape, dtype=np.float32)
+    disp = np.sqrt(im, out=_plot_state['disp']) # im**0.5, in a reused buffer
     #[AL, 2014.03.03 : Added power spectrum as well]                
-        f1 = plt.subplot(132)       
-        f1.imshow(np.abs(ac))                               
-        f1.plot(uv_samp_rev[:,0], uv_samp_rev[:,1], 'b.')
-        f1.axis((dz-uvw, dz+uvw, dz-uvw, dz+uvw))   
-                                
-        f2 = plt.subplot(133)
-        f2.imshow(np.angle(ac))                                 
-        f2.plot(uv_samp_rev[:,0], uv_samp_rev[:,1], 'b.')
-        f2.axis((dz-uvw, dz+uvw, dz-uvw, dz+uvw))                               
-        plt.draw()
-        plt.show()
+    panels = (disp, np.abs(ac), np.angle(ac))
+
+    if rebuild:
+        fig = plt.figure(1, (15,5))
+        fig.clf()
+        axes = [fig.add_subplot(131+i) for i in range(3)]
+        imgs = [ax.imshow(panel) for ax, panel in zip(axes, panels)]
+        dots = [ax.plot(uv_samp_rev[:,0], uv_samp_rev[:,1], 'b.')[0]
+                for ax in axes[1:]]
+        _plot_state.update(fig=fig, axes=axes, imgs=imgs, dots=dots,
+                           shape=im.shape)
+    else:
+        for img, panel in zip(_plot_state['imgs'], panels):
+            img.set_data(panel)
+            img.autoscale()
+        for dot in _plot_state['dots']:
+            dot.set_data(uv_samp_rev[:,0], uv_samp_rev[:,1])
 
-    return res
+    for ax in _plot_state['axes'][1:]:
+        ax.axis((dz-uvw, dz+uvw, dz-uvw, dz+uvw))
+    plt.draw()
+    plt.show()
+
+# =========================================================================
+# =========================================================================
+
+def _single_thread_worker():
+    ''' Pool initializer: one thread for the FFTs and the compiled kernels
+    of a worker process, since the processes already share the CPUs '''
+    global _fft_threads
+    _fft_threads = 1
+    if has_numba:
+        import numba
+        if hasattr(numba, 'set_num_threads'): # numba >= 0.49 only
+            numba.set_num_threads(1)
+
+def _prepare_frame(args):
+    ''' Recenter or window a single frame (multiprocessing helper) '''
+    frame, sg_rad, re_center, window = args
+    if re_center:
+        return recenter(frame, sg_rad=sg_rad, verbose=False, nbit=20)
+    elif window:
+        return window_image(im0=frame, sg_rad=sg_rad)
+    return frame.copy()
+
+def extract_from_array_batch(cube, hdr, kpi, threads=0, save_im=False, wfs=False, rev=-1.0, wrad=25.0, sg_ld=1.0, D=0.0, re_center=True, window=True, bsp=False, adjust_sampling=True, unwrap_kp=False, gpu=False):
+    ''' Extract the Kernel-phase signal from all the frames of a datacube.
+
+    ----------------------------------------------------------------
+    Same as calling extract_from_array() on each frame of the cube,
+    but the header, the uv sampling and the Fourier transforms are
+    dealt with once for the whole cube:
+
+    - the frames are recentered (or windowed) in parallel if threads>0
+    - a single FFT call transforms all the frames
+    - uv sampling adjustment (adjust_sampling) is done once, on the
+      common frame size
+
+    Parameters are:
+    - cube: the (nframes x ny x nx) array of frames to be examined
+    - hdr: the header info shared by all the frames
+    - kpi: the k-phase info structure to decode the data
+
+    Options:
+    - threads: number of processes to recenter the frames with
+    (default 0 = no multiprocessing)
+    - gpu: compute the Fourier Transforms on the GPU (requires CuPy,
+    the CPU is used otherwise)
+    - the other options are those of extract_from_array()
+
+    The function returns the same tuples as extract_from_array(),
+    every entry but kpd_info being stacked along the first axis:
+    - (kpd_info, kpd_signal, vis2 [, bsp_res])
+    - (kpd_info, kpd_signal, vis2, im, ac [,bsp_res])
+    - (kpd_info, kpd_phase [,bsp_res])
+    ---------------------------------------------------------------- '''
+
+    kpd_info, rev, sg_rad = _kpd_header(hdr, kpi, rev, wrad, sg_ld, D)
+    if sg_rad<=0 : sg_rad=cube.shape[2]
+
+    # read and fine-center the frames
+    args = [(frame, sg_rad, re_center, window) for frame in cube]
+    if threads == 0:
+        ims = [_prepare_frame(arg) for arg in args]
+    else:
+        pool = multiprocessing.Pool(processes=threads,
+                                    initializer=_single_thread_worker)
+        ims = pool.map(_prepare_frame, args)
+        pool.close()
+        pool.join()
+    im = np.array(ims)
+
+    sz = im.shape[1]  # frames are now square
+    uv_samp, uv_samp_rev = _uv_sampling(kpi, kpd_info, sz, rev, adjust_sampling)
+
+    # calculate and normalize the Fourier Transforms
+    # (single precision, as in extract_from_array)
+    cp = _cupy() if gpu else None
+    if gpu and cp is None:
+        print("CuPy is not available: the FFTs are computed on the CPU")
+    if cp is None:
+        ac = _centered_fft(im.astype(np.float32, copy=False))
+        ac = ac.astype(np.complex64, copy=False)
+        peak = (ac.real*ac.real + ac.imag*ac.imag).max(axis=(1,2))
+        ac /= (np.sqrt(peak) / kpi.nbh)[:,None,None]
+    else:
+        ac = _centered_fft_gpu(cp, im.astype(np.float32, copy=False))
+        peak = (ac.real*ac.real + ac.imag*ac.imag).max(axis=(1,2))
+        ac /= (cp.sqrt(peak) / kpi.nbh)[:,None,None]
+        ac = cp.asnumpy(ac)
+
+    obs = [_kpd_observables(frame, kpi, uv_samp_rev, bsp=bsp, unwrap_kp=unwrap_kp)
+           for frame in ac]
+    kpd_phase, kpd_signal, vis2, bsp_res = [np.array(x) for x in zip(*obs)]
+
+    return _kpd_results(kpd_info, kpd_phase, kpd_signal, vis2, im, ac, bsp_res,
+                        save_im=save_im, wfs=wfs, bsp=bsp)
 
 # =========================================================================
 # =========================================================================
@@ -753,10 +1163,60 @@ def extract_from_fits_frame(fname, kpi, save_im=True, wfs=False, plotim=True, ma
     - (kpd_info, kpd_signal, im, ac)
     - (kpd_info, kpd_phase)
     ----------------------------------------------------------------  '''
+    pf = _fits()
     im0=pf.getdata(fname)
     hdr = pf.getheader(fname)
     return extract_from_array(im0, hdr, kpi, save_im=save_im, wfs=wfs, plotim=plotim, manual=manual,  wrad=wrad, sg_ld=sg_ld, D=D,re_center=re_center, window=window,  bsp=bsp, adjust_sampling=adjust_sampling,unwrap_kp=unwrap_kp)
 
+# the kpi structure of a extract_from_fits_frames() worker process
+_worker_kpi = None
+
+def _init_fits_worker(kpi):
+    ''' Pool initializer: stores kpi once per worker process, on top of
+    _single_thread_worker() '''
+    global _worker_kpi
+    _worker_kpi = kpi
+    _single_thread_worker()
+
+def _extract_fits_frame_worker(args):
+    ''' extract_from_fits_frame() in a worker process (multiprocessing helper) '''
+    fname, kwargs = args
+    return extract_from_fits_frame(fname, _worker_kpi, **kwargs)
+
+def extract_from_fits_frames(fnames, kpi, threads=0, **kwargs):
+    ''' Extract the Kernel-phase signal from a list of fits frames.
+
+    ----------------------------------------------------------------
+    Same as calling extract_from_fits_frame() on each file, the files
+    being processed in parallel if threads>0.
+
+    Parameters are:
+    - fnames: the list of fits files to be examined
+    - kpi: the k-phase info structure to decode the data
+
+    Options:
+    - threads: number of processes (default 0 = no multiprocessing)
+    - the other (keyword) options are those of extract_from_fits_frame(),
+    except that plotim is False by default and manual is not supported
+    with multiprocessing (ValueError)
+
+    With multiprocessing, each process works on its own copy of kpi:
+    adjust_sampling does not modify the kpi that is passed.
+
+    The function returns the list of extract_from_fits_frame() results.
+    ---------------------------------------------------------------- '''
+    kwargs.setdefault('plotim', False)
+    if threads > 0 and kwargs.get('manual'):
+        raise ValueError('manual selection is not supported with threads>0')
+    if threads == 0:
+        return [extract_from_fits_frame(fname, kpi, **kwargs) for fname in fnames]
+    pool = multiprocessing.Pool(processes=threads, initializer=_init_fits_worker,
+                                initargs=(kpi,))
+    res = pool.map(_extract_fits_frame_worker, [(fname, kwargs) for fname in fnames])
+    pool.close()
+    pool.join()
+    return res
+
 
 # [AL, 2014.07.25]
 # this functions alters sampling points in uv plane in order to get integer sampling in uv plane
@@ -808,7 +1268,7 @@ def unwrap_uv_phases(data,uv0,maxVar=np.pi,return_image=False) :
     dz=sz//2
     #shifting initial array
     uv=np.array(np.round(uv0-dz),dtype=int)
-    if data.dtype=='complex' :              
+    if np.iscomplexobj(data) :              
         phases=np.angle(data)
     else :  phases=np.copy(data)                            
     res=np.empty((uv0.shape[0]),dtype=phases.dtype)
@@ -915,22 +1375,118 @@ def unwrap_uv_phases(data,uv0,maxVar=np.pi,return_image=False) :
 # =========================================================================
 # =========================================================================
 
+def _extract_bsp_rows(vis, uvrel, l, u, isComplex, nonred=False, showMessages=True):
+    ''' Bispectrum of the triangles (i<j<k) of sampling points, l to u-1.
+
+    Triangles are enumerated in lexicographic order, but all the (j,k)
+    pairs of a given first vertex i are processed at once, as arrays.
+    Stops as soon as u valid triangles have been found. With nonred,
+    only the first triangle of each (uv1,uv2,uv3) combination is kept. '''
+    nsp=uvrel.shape[0]
+    uvmax=np.maximum(uvrel,uvrel.T) # uv point of each pair (-1 = none)
+    direct=uvrel>=0                 # baseline i->j is the saved one
+    pj,pk=np.triu_indices(nsp,1)    # all pairs j<k, sorted by j then k
+    # pairs with j>i start at row i+1 of the upper triangle
+    start=np.concatenate(([0],np.cumsum(np.arange(nsp-1,0,-1))))
+    uv2all=uvmax[pj,pk]
+    dir2all=direct[pj,pk]
+    if nonred :
+        nuv=uvrel.max()+1
+        red=np.zeros((nuv**3,),dtype='bool') # a matrix to avoid redundancy
+    chunks=[]
+    total=0
+    for i in range(nsp-2) :
+        if total>=u :
+            break
+        if showMessages :
+            sys.stdout.write("\r                                     | Extracting bsp from img %d of %d" % (total+1-l,u))
+        s=start[i+1]
+        J,K=pj[s:],pk[s:]
+        uv1,uv2,uv3=uvmax[i,J],uv2all[s:],uvmax[i,K]
+        ok=np.flatnonzero((uv1>-1)&(uv2>-1)&(uv3>-1))
+        if nonred and ok.size :
+            # first occurrence of each uv triplet not seen in previous rows
+            key=(uv1[ok]*nuv+uv2[ok])*nuv+uv3[ok]
+            key,first=np.unique(key,return_index=True)
+            ok=ok[np.sort(first[~red[key]])]
+            red[key]=True
+        if not ok.size :
+            continue
+        J,K=J[ok],K[ok]
+        v1,v2,v3=vis[uv1[ok]],vis[uv2[ok]],vis[uv3[ok]]
+        d1,d2,d3=direct[i,J],dir2all[s:][ok],direct[i,K]
+        # Dealing with baseline directions for each of the three visibilities
+        # (the 3rd one is reverted to form a triangle)
+        if isComplex :
+            bsp=np.angle(np.where(d1,v1,v1.conj())*np.where(d2,v2,v2.conj())*
+                         np.where(d3,v3.conj(),v3))
+        else :
+            bsp=np.where(d1,v1,-v1)+np.where(d2,v2,-v2)+np.where(d3,-v3,v3)
+        chunks.append(bsp)
+        total+=bsp.size
+    if not chunks :
+        return np.asarray([])
+    return np.concatenate(chunks)[l:u]
+
+if has_numba:
+    @njit(cache=True)
+    def _extract_bsp_nonred(vis, uvrel, nuv, l, u, isComplex, out):
+        ''' Non-redundant bispectrum (triangles l to u-1) written into out.
+
+        The deduplication makes this path inherently sequential: it is kept
+        as the original triple loop, compiled. The uv triplets already seen
+        go in a set rather than a nuv**3 table: the table writes are
+        scattered over hundreds of MB for large nuv, and each one faults
+        in a new page. Returns the number of values written. '''
+        nsp = uvrel.shape[0]
+        red = set()
+        total = 0
+        for i in range(nsp):
+            for j in range(i+1, nsp):
+                a, b = uvrel[i, j], uvrel[j, i]
+                uv1 = a if a > b else b
+                if uv1 < 0:
+                    continue
+                for k in range(j+1, nsp):
+                    a, b = uvrel[j, k], uvrel[k, j]
+                    uv2 = a if a > b else b
+                    a, b = uvrel[i, k], uvrel[k, i]
+                    uv3 = a if a > b else b
+                    if uv2 < 0 or uv3 < 0:
+                        continue
+                    redidx = (uv1*nuv + uv2)*nuv + uv3
+                    if redidx in red:
+                        continue
+                    red.add(redidx)
+                    if total >= l:
+                        v1, v2, v3 = vis[uv1], vis[uv2], vis[uv3]
+                        if isComplex:
+                            if uvrel[i, j] < 0: v1 = v1.conjugate()
+                            if uvrel[j, k] < 0: v2 = v2.conjugate()
+                            if uvrel[i, k] >= 0: v3 = v3.conjugate()
+                            c = v1*v2*v3
+                            out[total-l] = math.atan2(c.imag, c.real)
+                        else:
+                            if uvrel[i, j] < 0: v1 = -v1
+                            if uvrel[j, k] < 0: v2 = -v2
+                            if uvrel[i, k] >= 0: v3 = -v3
+                            out[total-l] = (v1 + v2 + v3).real
+                    total += 1
+                    if total >= u:
+                        return total - l
+        return max(total - l, 0)
+
 #[AL, 07.05.2014] Extract bispectral phases for a given set of visibilities
 # vis - input visibilities or phases (in radians!!!)
 # uvrel - relations matrix between uv points and sampling points 
 # deg - return result in degrees 
 # rng - upper and lower bounds for bsp to be extracted. Used to reduce the resources usage
-# nonred - extract non-redundant Bsp only. Much slower
+# nonred - extract non-redundant Bsp only. Slower
 def extract_bsp(vis,uvrel,deg=True,rng=(0,50000),nonred=False,showMessages=True):
     # determining number of sampling points
     nsp=uvrel.shape[0]
-    # creating a relationship                               
     # maximum number of triangles                               
     n=nsp*(nsp-1)*(nsp-2)/6 
-    # number of uv points               
-    nuv=uvrel.max()+1
-    # a matrix to avoid redundancy
-    if nonred : red=np.zeros((nuv**3,),dtype='bool')                
     # determining lower limit               
     if rng[0]>=0 and rng[0]<n:
         l=rng[0]
@@ -945,58 +1501,24 @@ def extract_bsp(vis,uvrel,deg=True,rng=(0,50000),nonred=False,showMessages=True)
         u=l
     else:
         u=n                         
-    bsp_res=[]
     # visibilities or phases?
     isComplex=True              
     if nsp>0 :
-        if vis[0].dtype!='complex' :
+        if not np.iscomplexobj(vis[0]) :
             isComplex=False                                 
-    if u-l>0 :              
-        total=0                         
-        for i in range(0,nsp) :                                 
-            if total>=u :
-                break                                   
-            if showMessages :
-             sys.stdout.write("\r                                     | Extracting bsp from img %d of %d" % (total+1-l,u))                                                                                                                  
-            for j in range(i+1,nsp) :                                                   
-                if total>=u :
-                    break                                                       
-                for k in range(j+1,nsp) :                                                                   
-                    if total>=l:
-                        uv1=max(uvrel[i,j],uvrel[j,i])                                                                                      
-                        uv2=max(uvrel[j,k],uvrel[k,j])                                                                                      
-                        uv3=max(uvrel[i,k],uvrel[k,i])
-                        isRed=False                                                                                             
-                        if nonred : 
-                            redidx=uv1*nuv*nuv+uv2*nuv+uv3
-                            isRed=red[redidx]                                                                                                               
-                        if uv1>-1 and uv2>-1 and uv3>-1 and (not isRed):        
-                            if nonred : red[redidx]=True
-                            # Dealing with baseline directions for each of the three visibilities                                                                                   
-                            if uvrel[i,j]>=0 :                                                                                                          
-                                v1=vis[uv1]                                                                                                             
-                            else :                                                                                          
-                                if isComplex : v1=np.conjugate(vis[uv1])
-                                else : v1=-vis[uv1]
-                            if uvrel[j,k]>=0 :                                                                                                  
-                                v2=vis[uv2]
-                            else :                                                                                              
-                                if isComplex : v2=np.conjugate(vis[uv2])
-                                else : v2=-vis[uv2] 
-                            # the 3rd visibility is reverted to form a triangle                                                                                                                             
-                            if uvrel[i,k]>=0 :
-                                if isComplex : v3=np.conjugate(vis[uv3])
-                                else : v3=-vis[uv3]                                                                                                                     
-                            else :                                                                                                  
-                                v3=vis[uv3]                                                                                         
-                            if isComplex :                                                                                  
-                                bsp_res.append(np.angle(v1*v2*v3))
-                            else :
-                                bsp_res.append(v1+v2+v3)                                                                                                                
-                            total+=1                                                                                                            
-                    if total>=u :
-                        break
-    res=np.asarray(bsp_res)
+        # sampling points without any baseline are in no triangle: skip them
+        # (this keeps the order in which the other triangles are visited)
+        keep=np.flatnonzero((uvrel.max(axis=0)>=0)|(uvrel.max(axis=1)>=0))
+        if keep.size<nsp :
+            uvrel=uvrel[np.ix_(keep,keep)]
+    if u-l<=0 :
+        res=np.asarray([])
+    elif nonred and has_numba :
+        res=np.empty(u-l)
+        nuv=uvrel.max()+1
+        res=res[:_extract_bsp_nonred(np.asarray(vis),uvrel,nuv,l,u,isComplex,res)]
+    else :
+        res=_extract_bsp_rows(vis,uvrel,l,u,isComplex,nonred,showMessages)
     if deg :                                                                                            
         return res/dtor
     else :
@@ -1036,6 +1558,7 @@ def load_cube(fname,sg_rad=-1):
     Windows with a super-Gaussian window of radius sg_rad. If sg_rad is, as 
     is default, set to a negative umber, this makes the radius the size of the image'''
 
+    pf = _fits()
     dcube = pf.getdata(fname)
     hdr = pf.getheader(fname)
    
@@ -1081,21 +1604,17 @@ def recenter2(im0, D,wl,pscale,sg_rad=25.0,sigma=2):
     elif len(im0.shape)==3 :  
         szh = im0.shape[2] # horiz
         szv = im0.shape[1] # vertic     
-    temp = max(szh,szv) # max dimension of image            
-    for sz in [64, 128, 256, 512, 1024, 2048]:
-        if sz >= temp: break
+    sz = _fft_size(max(szh,szv)) # FFT-friendly size of padded image
     dz = sz/2.           # image half-size
-    orih, oriv = (sz-szh)/2, (sz-szv)/2
-    sgmask = super_gauss(sz, sz, dz, dz, sg_rad)    
+    sgmask = _sgmask(sz, sg_rad)
     
     x,y = np.meshgrid(np.arange(sz)-dz, np.arange(sz)-dz)
     wedge_x, wedge_y = x*np.pi/dz, y*np.pi/dz
     offset = np.zeros((sz, sz), dtype=complex) # to Fourier-center array
 
-    # insert image in zero-padded array (dim. power of two)
+    # insert image in zero-padded array (FFT-friendly dim.)
     if len(im0.shape)==2 :  
-        im = np.zeros((sz, sz))
-        im[oriv:oriv+szv,orih:orih+szh] = im0
+        im = _zero_pad(im0, sz)
         (x0, y0) = find_psf_center2(im, D,wl,pscale,sigma)
         im -= np.median(im)
         mynorm = (im * sgmask).sum()
@@ -1114,8 +1633,7 @@ def recenter2(im0, D,wl,pscale,sg_rad=25.0,sigma=2):
         # image masking, and set integral to right value        
         im=im * mynorm / im.sum()
     elif len(im0.shape)==3 :  
-        im = np.zeros((im0.shape[0],sz, sz))
-        im[:,oriv:oriv+szv,orih:orih+szh] = im0
+        im = _zero_pad(im0, sz)
         for i in range(im.shape[0]) : 
             (x0, y0) = find_psf_center2(im[i], D,wl,pscale,sigma) 
             im[i] -= np.median(im[i])
@@ -1158,7 +1676,7 @@ def recenter3(array, sg_rad=25.0, rad=2) :
     if sg_rad>0 :
         im=window_image(array,sg_rad)
     else :  im=array   
-    ac = shift(fft(shift(im)))
+    ac = _centered_fft(im)
     x_cen=ac.shape[0]//2
     y_cen=ac.shape[0]//2
     # getting points to fit the plane